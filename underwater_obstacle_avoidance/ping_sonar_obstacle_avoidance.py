@@ -2,10 +2,19 @@
 
 # ping_sonar_obstacle_avoidance.py
 import datetime
+import linecache
 import time
 import math
+import os
 import argparse
-import csv
+import atexit
+import base64
+import queue
+import selectors
+import threading
+from functools import partial
+from operator import itemgetter
+import numpy as np
 from brping import Ping1D
 
 
@@ -19,7 +28,7 @@ Sources:
 2. Get profile, distance, range, confidence
 3. Convert distances from mm to m
 4. Get time delta (dt) to calculate object velocity
-5. (optional) add a filter to reduce noise. NOTE: DON'T BOTHER FOR NOW AS THE CONFIDENCE AND DISTANCES DO NOT NECESSARILY REFER TO ONE OBJECT ONLY
+5. Moving average over the last DISTANCE_FILTER_WINDOW distances to reduce noise, logged as distance_filtered. NOTE: THE CONFIDENCE AND DISTANCES DO NOT NECESSARILY REFER TO ONE OBJECT ONLY
 6. Filter/remove confidence below threshold (using a low pass filter). todo: Annette
 7. Ignore measurements <= min distance and >= max distance
 8. Save to CSV (https://discuss.bluerobotics.com/t/retrieve-ping-sonar-data-for-analysis/11795/2)
@@ -41,12 +50,207 @@ Todo:
 """
 
 MM_TO_M = 0.001
+CSV_QUEUE_SIZE = 1024  # rows buffered between range_callback and the CSV writer thread
+CSV_BATCH_SIZE = 50  # rows written to the CSV file in one go
+CSV_FLUSH_SEC = 1.0  # maximum age in seconds of a row waiting in the batch
+CSV_BUFFER_SIZE = 1 << 16  # file buffer size in bytes
+CSV_FLUSH_MODES = ('batch', 'line', 'fsync')
+CSV_COLUMNS = (
+    'time', 'distance', 'confidence', 'transmit_duration', 'ping_number', 'max_range',
+    'gain_setting', 'profile_data', 'speed_of_sound',
+    'firmware_version_major', 'firmware_version_minor', 'ping_interval', 'mode_auto',
+    'peak_distance', 'peak_strength', 'distance_filtered')
+PROFILE_LEN = 200  # number of bins in a Ping1D profile
+PROFILE_RING_SIZE = 1024  # profiles kept in memory before they are saved to a .npz file
+# time (s since epoch), distance (m), confidence (%) and ping number stored next to every profile in the .npz files
+PROFILE_META_DTYPE = np.dtype([('t', 'f8'), ('d', 'f4'), ('c', 'u1'), ('pn', 'u4')])
+# fields of a Ping1D profile message, fetched from the message dict in a single call
+_PROFILE_KEYS = itemgetter('distance', 'confidence', 'transmit_duration', 'ping_number', 'scan_start', 'scan_length',
+                           'gain_setting', 'profile_data')
+DISTANCE_FILTER_WINDOW = 5  # number of accepted distances averaged by the moving average filter
+INFO_REFRESH_INTERVAL = 100  # polls between re-reading general_info and speed_of_sound from the device
+MAX_POLL_RATE = 30.0  # in Hz, also the limit for polls triggered early by data from the device
+
+# Source fragments of range_callback. Each fragment is tagged with the instance setting it depends on ('csv', 'verbose'
+# or 'confidence', None for always). _compile_range_callback joins the fragments an instance needs, so the compiled
+# function only contains the code paths that instance will ever take.
+_RANGE_CALLBACK_FRAGMENTS = (
+    (None, """\
+def range_callback(self):
+    # bind the attributes and globals used on every poll to locals
+    mm = MM_TO_M
+    get_profile = self.ping.get_profile
+    wait_for_next_poll = self.wait_for_next_poll
+"""),
+    ('csv', """\
+    put_row = self._csv_queue.put_nowait
+    current_time = datetime.datetime.now(datetime.timezone.utc).strftime('%H:%M:%S.%f')[:-3]
+"""),
+    (None, """\
+    data = get_profile()
+    # counted for every poll, including repeated, low-confidence and failed ones
+    self._polls += 1
+    if self._info_dirty or self._polls % INFO_REFRESH_INTERVAL == 0:
+        self.refresh_device_info()
+    if not data:
+        print("Failed to get data")
+        wait_for_next_poll()
+        return data, self._cached_info, self._cached_sos
+
+    # get_profile() returns either None or a complete profile message, so all keys are present
+    (distance_mm, confidence, transmit_duration, ping_number, scan_start_mm, scan_length_mm, gain_setting,
+     profile_data_list) = _PROFILE_KEYS(data)
+
+    # The pulse/measurement count since boot. An unchanged count means the device has not produced a new
+    # measurement since the last poll, so there is nothing new to process or log
+    if ping_number == self._last_ping_number:
+        wait_for_next_poll()
+        return data, None, None
+    self._last_ping_number = ping_number
+"""),
+    ('confidence', """\
+
+    # Units: %. Confidence in the most recent range measurement. Samples below min_confidence are dropped
+    # before any conversion, formatting or logging is done for them
+    if confidence < self.min_confidence:
+        wait_for_next_poll()
+        return data, None, None
+"""),
+    (None, """\
+
+    # Units: mm. The current return distance determined for the most recent acoustic measurement converted to m
+    distance = distance_mm * mm  # in m
+    distance_filtered = self.filter_distance(distance)
+    # Units: us. transmit_duration is the acoustic pulse length during acoustic transmission/activation.
+"""),
+    ('csv', """\
+
+    # note that running self.ping.get_range() gives scan_start and scan_length
+    # Units: mm; The beginning of the scan region in mm from the transducer.
+    scan_start = scan_start_mm * mm
+    # Units: mm; The length of the scan region.
+    scan_length = scan_length_mm * mm
+
+    max_range = scan_start + scan_length
+    # gain_setting is the current gain setting (equivalent to self.ping.get_gain_setting()). It is logged from the
+    # profile rather than the cached general_info, since in auto mode the device changes it from ping to ping.
+    # 0: 0.6, 1: 1.8, 2: 5.5, 3: 12.9, 4: 30.2, 5: 66.1, 6: 144
+
+    bin_count = len(profile_data_list)
+    assert bin_count == PROFILE_LEN, f"Unexpected data length encountered ({bin_count} != {PROFILE_LEN}) - adjust CSV creation code"
+
+    # Strongest return in the profile and its range in m, evaluated over all bins at once with numpy
+    profile = np.frombuffer(profile_data_list, dtype=np.uint8)
+    peak_idx = int(profile.argmax())
+    peak_strength = int(profile[peak_idx])
+    peak_distance = scan_start + (peak_idx / bin_count) * scan_length
+
+    # The profile is logged quantized to 4 bits, two bins per byte, and base64 encoded in the CSV.
+    # Read back with decode_profile()
+    packed_profile = pack_profile(profile)
+    profile_data = base64.b64encode(packed_profile.tobytes()).decode('ascii')
+"""),
+    ('verbose', """\
+
+    # printing to a terminal takes a variable amount of time, so it is subsampled
+    if (self._iter & 15) == 0:
+        print(list(profile_data_list))
+        print(f"Distance: {distance} meters, Confidence: {confidence}, Transmit Duration: {transmit_duration}")
+"""),
+    (None, """\
+
+    self._iter += 1
+    speed_of_sound = self._cached_sos
+    general_info = self._cached_info
+"""),
+    ('csv', """\
+
+    firmware_version_major = None
+    firmware_version_minor = None
+    ping_interval = None
+    mode_auto = None
+    if general_info:
+        firmware_version_major = general_info.get("firmware_version_major", 0)
+        firmware_version_minor = general_info.get("firmware_version_minor", 0)
+        ping_interval = general_info.get("ping_interval", 0)  #  Units: ms; The interval between acoustic measurements.
+        mode_auto = general_info.get("mode_auto", 0)  # 0: manual, 1: auto
+
+    try:
+        put_row([
+            current_time, distance, confidence, transmit_duration, ping_number,
+            max_range, gain_setting, profile_data, speed_of_sound, firmware_version_major,
+            firmware_version_minor, ping_interval, mode_auto, peak_distance, peak_strength,
+            distance_filtered
+        ])
+    except queue.Full:
+        print("CSV queue full, dropping row")
+    self.write_profile(packed_profile, distance, confidence, ping_number)
+"""),
+    (None, """\
+    wait_for_next_poll()
+    return data, general_info, speed_of_sound
+"""),
+)
+_RANGE_CALLBACKS = {}  # compiled range_callback variants keyed on (csv, verbose, confidence)
+
+
+def _compile_range_callback(csv_enabled, verbose, confidence_gate):
+    """
+    Compile (once per combination) the range_callback variant for the given settings
+    :param csv_enabled: rows and profiles are logged
+    :param verbose: measurements are printed
+    :param confidence_gate: samples below min_confidence are dropped, off when min_confidence <= 0
+    :return: range_callback function, to be bound to an instance
+    """
+    key = (csv_enabled, verbose, confidence_gate)
+    if key not in _RANGE_CALLBACKS:
+        enabled = {None: True, 'csv': csv_enabled, 'verbose': verbose, 'confidence': confidence_gate}
+        source = ''.join(fragment for flag, fragment in _RANGE_CALLBACK_FRAGMENTS if enabled[flag])
+        filename = f'<range_callback csv={csv_enabled} verbose={verbose} confidence={confidence_gate}>'
+        # register the source so that tracebacks show the generated lines
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        namespace = {}
+        exec(compile(source, filename, 'exec'), globals(), namespace)
+        _RANGE_CALLBACKS[key] = namespace['range_callback']
+    return _RANGE_CALLBACKS[key]
+
+
+def pack_profile(profile):
+    """
+    Quantize return strengths to their upper 4 bits and pack two bins per byte, the first bin in the upper nibble
+    :param profile: uint8 numpy array of return strengths, the last axis is the bins
+    :return: uint8 numpy array with half as many bins
+    """
+    quantized = profile >> 4
+    return (quantized[..., ::2] << 4) | quantized[..., 1::2]
+
+
+def unpack_profile(packed_profile):
+    """
+    Inverse of pack_profile. Strengths are returned on the original 0..255 scale with the lower 4 bits zeroed
+    :param packed_profile: uint8 numpy array as returned by pack_profile, e.g. the profile array of the .npz files
+    :return: uint8 numpy array with one return strength per bin
+    """
+    profile = np.empty(packed_profile.shape[:-1] + (packed_profile.shape[-1] * 2,), dtype=np.uint8)
+    profile[..., ::2] = packed_profile & 0xF0
+    profile[..., 1::2] = (packed_profile & 0x0F) << 4
+    return profile
+
+
+def decode_profile(profile_data):
+    """
+    Decode a profile_data field of the CSV file back into the array of return strengths
+    :param profile_data: base64 encoded packed profile as written to the CSV file
+    :return: uint8 numpy array with one return strength per bin, quantized to 4 bits (see unpack_profile)
+    """
+    return unpack_profile(np.frombuffer(base64.b64decode(profile_data), dtype=np.uint8))
 
 
 class PingSonarObstacleAvoidance:
     def __init__(self, baudrate=115200, ping_port='COM3', udp_address=None, device_type='Ping1D',
                  poll_rate=20.0, min_distance=1.0, max_distance=3, speed_of_sound=344.0,
-                 min_confidence=30, gain=1, ping_interval=100, mode_auto=False, fov=30.0, csv_path=""
+                 min_confidence=30, gain=1, ping_interval=100, mode_auto=False, fov=30.0, csv_path="",
+                 csv_flush_mode='batch', verbose=False
 ):
         """
         Input units are in meters but converted to millimeters for use with the device and returned values in meters
@@ -63,6 +267,13 @@ class PingSonarObstacleAvoidance:
         :param ping_interval:
         :param mode_auto:
         :param fov:
+        :param csv_path:
+        :param csv_flush_mode: 'batch' writes rows in batches (fastest), 'line' flushes every row so the file can be
+            tailed during a run, 'fsync' also syncs every written row to disk. In all modes rows are written by the
+            CSV writer thread, so the poll rate does not depend on the disk: if the disk falls behind, the queue fills
+            up and new rows are dropped ("CSV queue full, dropping row"). On a power loss, the rows still waiting in
+            the queue (up to CSV_QUEUE_SIZE) are lost, and in 'batch' mode also the unwritten batch
+        :param verbose: print every 16th accepted measurement to stdout
         """
         self.baudrate = baudrate
         self.ping_port = ping_port  # /dev/ttyUSB0 for Linux and COM3 for Windows
@@ -80,12 +291,16 @@ class PingSonarObstacleAvoidance:
         self.ping_interval = ping_interval
         self.mode_auto = bool(mode_auto)
         self.fov = math.radians(fov)  # field of view in degrees
+        self.verbose = verbose
 
         # todo: @Elias: what are the values for minimum and maximum range, rates, lengths, etc?
         if self.poll_rate <= 5.0:
             self.poll_rate = 5.0
-        elif self.poll_rate >= 30.0:
-            self.poll_rate = 30.0
+        elif self.poll_rate >= MAX_POLL_RATE:
+            self.poll_rate = MAX_POLL_RATE
+        self._period = 1.0 / self.poll_rate  # in s
+        # deadline of the next poll on the monotonic clock, advanced by one period every iteration
+        self._next_deadline = time.perf_counter()
 
         self.ping = None
         if self.device_type == 'Ping1D':
@@ -99,27 +314,112 @@ class PingSonarObstacleAvoidance:
             if self.ping.initialize() is False:
                 raise RuntimeError('Could not initialize Ping1D')
 
+        # Wait on the serial port between polls so that data sent by the device wakes the loop before the deadline.
+        # Selecting on a serial port is not supported on Windows, and over UDP the loop falls back to time.sleep
+        self._selector = None
+        if self.ping is not None and self.ping_port is not None and os.name != 'nt':
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.ping.iodev.fileno(), selectors.EVENT_READ)
+
         self.gain_dict = {0: 0.6, 1: 1.8, 2: 5.5, 3: 12.9, 4: 30.2, 5: 66.1, 6: 144}
 
         if self.gain_dict.get(self.gain) is None:
             raise RuntimeError('Invalid gain setting')
 
+        if csv_flush_mode not in CSV_FLUSH_MODES:
+            raise RuntimeError('Invalid csv_flush_mode')
+        self.csv_flush_mode = csv_flush_mode
+
+        self._applied_settings = {}  # last value successfully written to the device for each setter
         self.set_device_properties()
+        # general_info and speed_of_sound rarely change, so they are read once here and only re-read every
+        # INFO_REFRESH_INTERVAL polls or after the device properties have been set again
+        self._polls = 0
+        self._iter = 0  # accepted samples, used to subsample the verbose output
+        self._cached_sos = None
+        self._cached_info = None
+        self.refresh_device_info()
+        self._last_ping_number = -1
+
+        # circular buffer of the last accepted distances and their running sum for the moving average filter
+        self._dist_buf = np.zeros(DISTANCE_FILTER_WINDOW)
+        self._dist_i = 0
+        self._dist_n = 0
+        self._dist_sum = 0.0
+
         self.csv_file = None
+        self._csv_queue = None
+        self._csv_thread = None
         if len(csv_path) > 0:
-            self.csv_file = open(csv_path, 'w', newline='')
-            self.csv_writer = csv.writer(self.csv_file, delimiter=',')
-            self.write_to_csv([
-                'time', 'distance', 'confidence', 'transmit_duration', 'ping_number', 'max_range',
-                'gain_setting', 'profile_data', 'speed_of_sound',
-                'firmware_version_major', 'firmware_version_minor', 'ping_interval', 'mode_auto'])
+            if self.csv_flush_mode == 'batch':
+                self.csv_file = open(csv_path, 'w', newline='', buffering=CSV_BUFFER_SIZE)
+                self._csv_batch_size = CSV_BATCH_SIZE
+            else:
+                self.csv_file = open(csv_path, 'w', newline='', buffering=1)  # line buffered
+                self._csv_batch_size = 1
+            # No field ever contains a comma (profile_data is base64 encoded), so rows are formatted with a fixed
+            # format string instead of csv.writer, which re-does quoting and field dispatch for every row
+            self._row_fmt = (','.join(['{}'] * len(CSV_COLUMNS)) + '\n').format
+            # rows are written by a separate thread so that range_callback never blocks on disk I/O
+            self._csv_queue = queue.Queue(maxsize=CSV_QUEUE_SIZE)
+            self._row_buf = []
+            self._last_flush = time.monotonic()
+            self._csv_thread = threading.Thread(target=self._csv_worker, name='csv_writer', daemon=True)
+            self._csv_thread.start()
+            # profiles are also kept in contiguous arrays and saved in chunks of PROFILE_RING_SIZE to
+            # <csv name>_profiles_0000.npz, <csv name>_profiles_0001.npz, ... for post-analysis with numpy.
+            # Profiles are stored packed by pack_profile, read them back with unpack_profile
+            self._profile_path = os.path.splitext(csv_path)[0] + '_profiles'
+            self._profile_ring = np.zeros((PROFILE_RING_SIZE, PROFILE_LEN // 2), dtype=np.uint8)
+            self._meta_ring = np.zeros(PROFILE_RING_SIZE, dtype=PROFILE_META_DTYPE)
+            self._ring_i = 0
+            self._ring_chunk = 0
+            # write out the last batch if the script is stopped without calling close()
+            atexit.register(self.close)
+            self.write_to_csv(CSV_COLUMNS)
+
+        self.specialize_range_callback()
 
     def set_device_properties(self):
-        self.ping.set_speed_of_sound(int(self.speed_of_sound))
-        self.ping.set_range(int(self.scan_start), int(self.scan_range))
-        self.ping.set_ping_interval(int(self.ping_interval))
-        self.ping.set_gain_setting(int(self.gain))
-        self.ping.set_mode_auto(int(self.mode_auto))
+        """
+        Write the properties to the device. Each setter is a serial round-trip, so only the values that differ from
+        what was last applied are written.
+        In auto mode the device picks range and gain itself, so the applied range and gain are only trusted while
+        the device stays in manual mode. They are written again when auto mode is on or is being switched. When
+        switching to manual mode, mode auto is written first so that the device keeps the range and gain written
+        after it; otherwise it is written last, after the gain.
+        """
+        if self.mode_auto or self._applied_settings.get('mode_auto') != (int(self.mode_auto),):
+            self._applied_settings.pop('range', None)
+            self._applied_settings.pop('gain_setting', None)
+        settings = (
+            ('speed_of_sound', self.ping.set_speed_of_sound, (int(self.speed_of_sound),)),
+            ('range', self.ping.set_range, (int(self.scan_start), int(self.scan_range))),
+            ('ping_interval', self.ping.set_ping_interval, (int(self.ping_interval),)),
+            ('gain_setting', self.ping.set_gain_setting, (int(self.gain),)),
+        )
+        mode_auto = ('mode_auto', self.ping.set_mode_auto, (int(self.mode_auto),))
+        settings = settings + (mode_auto,) if self.mode_auto else (mode_auto,) + settings
+        for name, setter, value in settings:
+            if self._applied_settings.get(name) == value:
+                continue
+            # setters return False if the device did not acknowledge the new value, keep it unapplied to retry later
+            if setter(*value):
+                self._applied_settings[name] = value
+            self._info_dirty = True
+
+    def refresh_device_info(self):
+        """
+        Re-read speed_of_sound and general_info from the device. Both getters return None when the device does not
+        answer, in which case the previously read values are kept.
+        """
+        speed_of_sound_info = self.ping.get_speed_of_sound()
+        if speed_of_sound_info:
+            self._cached_sos = speed_of_sound_info.get("speed_of_sound", 343.0) * MM_TO_M
+        general_info = self.ping.get_general_info()
+        if general_info:
+            self._cached_info = general_info
+        self._info_dirty = False
 
     def get_distance(self):
         # data = self.ping.get_distance()
@@ -128,89 +428,178 @@ class PingSonarObstacleAvoidance:
 
     def write_to_csv(self, csv_row):
         if self.csv_file is not None:
-            self.csv_writer.writerow(csv_row)
+            try:
+                self._csv_queue.put_nowait(csv_row)
+            except queue.Full:
+                print("CSV queue full, dropping row")
 
-    def differentiate_distance(self, distance_delta, dt):
-        pass
+    def write_profile(self, packed_profile, distance, confidence, ping_number):
+        if self.csv_file is not None:
+            i = self._ring_i
+            self._profile_ring[i] = packed_profile
+            self._meta_ring[i] = (time.time(), distance, confidence, ping_number)
+            self._ring_i = i + 1
+            if self._ring_i == PROFILE_RING_SIZE:
+                self._flush_profiles()
+
+    def _flush_profiles(self):
+        if self._ring_i == 0:
+            return
+        path = f'{self._profile_path}_{self._ring_chunk:04d}.npz'
+        save = partial(np.savez, path, profile=self._profile_ring[:self._ring_i].copy(),
+                       meta=self._meta_ring[:self._ring_i].copy())
+        # saved by the writer thread, wait rather than drop a whole chunk when the queue is full
+        if not self._put_to_writer(save):
+            print("CSV writer thread stopped, dropping profiles")
+        self._ring_i = 0
+        self._ring_chunk += 1
+
+    def _put_to_writer(self, item):
+        """
+        Put an item on the CSV queue, waiting while the queue is full but only as long as the writer thread runs
+        :return: False if the writer thread is not running and the item was not queued
+        """
+        while self._csv_thread.is_alive():
+            try:
+                self._csv_queue.put(item, timeout=CSV_FLUSH_SEC)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _csv_worker(self):
+        while True:
+            try:
+                item = self._csv_queue.get(timeout=CSV_FLUSH_SEC)
+            except queue.Empty:
+                self._flush_csv()
+                continue
+            if item is None:
+                break
+            if callable(item):
+                # errors are reported and the worker keeps running, so that the queue never stops draining
+                try:
+                    item()
+                except Exception as exception:
+                    print("Failed to save profiles: {0}".format(exception))
+                continue
+            self._row_buf.append(item)
+            if len(self._row_buf) >= self._csv_batch_size or time.monotonic() - self._last_flush >= CSV_FLUSH_SEC:
+                self._flush_csv()
+        self._flush_csv()
+
+    def _flush_csv(self):
+        if self._row_buf:
+            row_fmt = self._row_fmt
+            try:
+                # None is written as an empty field, as csv.writer does
+                self.csv_file.write(''.join(row_fmt(*('' if field is None else field for field in row))
+                                            for row in self._row_buf))
+                self.csv_file.flush()
+                if self.csv_flush_mode == 'fsync':
+                    os.fsync(self.csv_file.fileno())
+            except Exception as exception:
+                # e.g. disk full, the batch is dropped and the worker keeps draining the queue
+                print("Failed to write CSV rows: {0}".format(exception))
+            self._row_buf.clear()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Save the remaining profiles, stop the CSV writer thread once all queued rows are written and close the CSV file.
+        """
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        if self.csv_file is None:
+            return
+        self._flush_profiles()
+        self._put_to_writer(None)
+        self._csv_thread.join()
+        try:
+            self.csv_file.close()
+        except Exception as exception:
+            print("Failed to close CSV file: {0}".format(exception))
+        self.csv_file = None
+        # release the reference held by atexit so that closed instances can be garbage collected
+        atexit.unregister(self.close)
+        self.specialize_range_callback()
 
     def range_callback(self):
-        current_time = datetime.datetime.now(datetime.timezone.utc).strftime('%H:%M:%S.%f')[:-3]
-        data = self.get_distance()
-
-            # Initialize variables with default values
-        distance = None
-        confidence = None
-        transmit_duration = None
-        ping_number = None
-        scan_start = None
-        scan_length = None
-        max_range = None
-        gain_setting = None
-        profile_data = None
-        speed_of_sound = None
-        firmware_version_major = None
-        firmware_version_minor = None
-        ping_interval = None
-        mode_auto = None
-        previous_ping = 0
-
-        if data:
-            # Units: mm. The current return distance determined for the most recent acoustic measurement converted to m
-            distance = data.get('distance', 0) * MM_TO_M  # in m
-            # Units: %. Confidence in the most recent range measurement.
-            confidence = data.get('confidence', 0)
-            # Units: us. The acoustic pulse length during acoustic transmission/activation.
-            transmit_duration = data.get('transmit_duration', 0)
-            # The pulse/measurement count since boot.
-            ping_number = data.get('ping_number', 0)
-
-
-            # note that running self.ping.get_range() gives scan_start and scan_length
-            # Units: mm; The beginning of the scan region in mm from the transducer.
-            scan_start = data.get('scan_start', 0)* MM_TO_M
-            # Units: mm; The length of the scan region.
-            scan_length = data.get('scan_length', 0) * MM_TO_M
-
-            max_range = scan_start + scan_length
-            # The current gain setting. 0: 0.6, 1: 1.8, 2: 5.5, 3: 12.9, 4: 30.2, 5: 66.1, 6: 144
-            gain_setting = data.get('gain_setting', 0)  # equivalent to self.ping.get_gain_setting()
-
-            profile_data_list = data.get('profile_data', [])
-            bin_count = len(profile_data_list)
-            assert bin_count == 200, f"Unexpected data length encountered ({bin_count} != 200) - adjust CSV creation code"
-            profile_data = ','.join(str(response_strength) for response_strength in profile_data_list)
-
-            if confidence >= 30 and previous_ping != ping_number:
-               print(list(data['profile_data']))
-               print(f"Distance: {distance} meters, Confidence: {confidence}, Transmit Duration: {transmit_duration}")
-
-        else:
-            print("Failed to get data")
+        """
+        Poll the device once, log the measurement and wait for the next poll.
+        The code is compiled per instance by specialize_range_callback. This method compiles the variant for the
+        current settings and dispatches to it; afterwards calls go to the compiled variant directly.
+        :return: profile data, general_info and speed_of_sound. (data, None, None) for repeated and low-confidence
+            measurements
+        """
+        return self.specialize_range_callback()()
 
-        speed_of_sound_info = self.ping.get_speed_of_sound()
-        if speed_of_sound:
-            speed_of_sound = speed_of_sound_info.get("speed_of_sound", 343.0) * MM_TO_M
+    def specialize_range_callback(self):
+        """
+        Set range_callback of this instance to the variant compiled for its settings: CSV logging, verbose and
+        whether confidence filtering is enabled. Each poll then skips the branches that are fixed for the instance.
+        Call again after changing verbose or min_confidence. If a subclass overrides range_callback, the override
+        is left in place and super().range_callback() still dispatches to the compiled variant.
+        :return: the compiled range_callback bound to this instance
+        """
+        callback = _compile_range_callback(self.csv_file is not None, bool(self.verbose),
+                                           self.min_confidence > 0).__get__(self)
+        if type(self).range_callback is PingSonarObstacleAvoidance.range_callback:
+            self.range_callback = callback
+        return callback
 
-        general_info = self.ping.get_general_info()
-        if general_info:
-            firmware_version_major = general_info.get("firmware_version_major", 0)
-            firmware_version_minor = general_info.get("firmware_version_minor", 0)
-            ping_interval = general_info.get("ping_interval", 0)  #  Units: ms; The interval between acoustic measurements.
-            gain_setting = general_info.get("gain_setting", 0)
-            mode_auto = general_info.get("mode_auto", 0)  # 0: manual, 1: auto
-
-        if confidence >= 30 and previous_ping != ping_number:
-            self.write_to_csv([
-                current_time, distance, confidence, transmit_duration, ping_number,
-                max_range, gain_setting, profile_data, speed_of_sound, firmware_version_major,
-                firmware_version_minor, ping_interval, mode_auto
-            ])
-        time.sleep(1 / self.poll_rate)
-        previous_ping = ping_number
-        return data, general_info, speed_of_sound
+    def run(self):
+        """
+        Poll the device until interrupted, then close the CSV file.
+        """
+        try:
+            while True:
+                self.range_callback()
+        finally:
+            self.close()
+
+    def filter_distance(self, distance):
+        """
+        Moving average of the last DISTANCE_FILTER_WINDOW distances. The running sum is updated with the new and the
+        oldest distance, so each update is O(1). Until the window is full the average is over the distances seen so far.
+        """
+        i = self._dist_i
+        old = float(self._dist_buf[i])
+        self._dist_buf[i] = distance
+        self._dist_sum += distance - old
+        self._dist_i = (i + 1) % DISTANCE_FILTER_WINDOW
+        if self._dist_n < DISTANCE_FILTER_WINDOW:
+            self._dist_n += 1
+        return self._dist_sum / self._dist_n
+
+    def differentiate_distance(self, distance_delta, dt):
+        pass
+
+    def wait_for_next_poll(self):
+        """
+        Sleep until the next poll deadline instead of a fixed 1 / poll_rate so that the time spent on serial I/O
+        and logging does not lower the effective poll rate. On overrun the schedule is reset to now rather than
+        trying to catch up with back-to-back polls.
+        If data from the device wakes the wait early, the next poll happens right away but never sooner than
+        1 / MAX_POLL_RATE after the previous one, and the schedule restarts from that poll.
+        """
+        previous_deadline = self._next_deadline
+        self._next_deadline += self._period
+        delay = self._next_deadline - time.perf_counter()
+        if delay <= 0:
+            self._next_deadline = time.perf_counter()
+        elif self._selector is None:
+            time.sleep(delay)
+        elif self._selector.select(timeout=delay):
+            earliest = previous_deadline + 1.0 / MAX_POLL_RATE
+            now = time.perf_counter()
+            if now < earliest:
+                time.sleep(earliest - now)
+                now = earliest
+            self._next_deadline = now
 
 
 if __name__ == '__main__':
-    psoa = PingSonarObstacleAvoidance(csv_path='Trial28.csv')
-    while True:
-        psoa.range_callback()
+    psoa = PingSonarObstacleAvoidance(csv_path='Trial28.csv', verbose=True)
+    psoa.run()